@@ -1,29 +1,30 @@
 import re
 
+# Precompiled at module load so per-email processing skips the pattern
+# compile/cache lookup
+EMAIL_PATTERN = re.compile(r'[\w\.-]+@[\w\.-]+')
+URL_PATTERN = re.compile(r'https?://\S+')
+QUOTE_PATTERN = re.compile(r'^>.*$')
+REPLY_HEADER_PATTERN = re.compile(r'^On .+ wrote:')
+
 def anonymize_emails_and_urls(email):
     """Anonymize email addresses and URLs in the email content."""
-    email_pattern = r'[\w\.-]+@[\w\.-]+'
-    url_pattern = r'https?://\S+'
-    
     if isinstance(email, dict):
         for k in ['subject', 'body']:
             if k in email:
-                email[k] = re.sub(email_pattern, '[EMAIL]', email[k])
-                email[k] = re.sub(url_pattern, '[URL]', email[k])
+                email[k] = EMAIL_PATTERN.sub('[EMAIL]', email[k])
+                email[k] = URL_PATTERN.sub('[URL]', email[k])
     elif isinstance(email, str):
-        email = re.sub(email_pattern, '[EMAIL]', email)
-        email = re.sub(url_pattern, '[URL]', email)
-    
+        email = EMAIL_PATTERN.sub('[EMAIL]', email)
+        email = URL_PATTERN.sub('[URL]', email)
+
     return email
 
 def remove_quoted_and_reply_lines(email):
     """Remove quoted text (lines starting with '>') and reply headers ('On ... wrote:')."""
-    quote_pattern = r'^>.*$'
-    reply_header_pattern = r'^On .+ wrote:'
-    
     def clean_text(text):
         lines = text.split('\n')
-        filtered = [line for line in lines if not re.match(quote_pattern, line) and not re.match(reply_header_pattern, line)]
+        filtered = [line for line in lines if not QUOTE_PATTERN.match(line) and not REPLY_HEADER_PATTERN.match(line)]
         return '\n'.join(filtered)
     
     if isinstance(email, dict):